@@ -0,0 +1,8 @@
+import os
+
+# INT8 ONNX export produced by export_onnx.py
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "whisper-onnx-int8")
+
+# CPU backend to load: faster_whisper, whisper_cpp, onnx or hugging_face.
+# Unset tries each installed backend in that order.
+CPU_BACKEND = os.environ.get("WHISPER_CPU_BACKEND", "").strip().lower() or None
@@ -0,0 +1,54 @@
+"""Export Whisper-large-v3-turbo to ONNX and quantize it to INT8 for the CPU path.
+
+Run once after installing the optional ONNX dependencies:
+
+    pip install "optimum[onnxruntime]"
+    python export_onnx.py
+
+The quantized model is written to ``whisper-onnx-int8/`` next to this file.
+Start the backend with ``WHISPER_CPU_BACKEND=onnx`` to use it.
+"""
+import logging
+import os
+import tempfile
+
+from optimum.onnxruntime import ORTModelForSpeechSeq2Seq, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoProcessor
+
+from config import ONNX_MODEL_DIR
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+MODEL_ID = "openai/whisper-large-v3-turbo"
+
+
+def export_onnx_int8(model_id: str = MODEL_ID, save_dir: str = ONNX_MODEL_DIR):
+    with tempfile.TemporaryDirectory() as export_dir:
+        # Equivalent to optimum-cli export onnx --task automatic-speech-recognition-with-past
+        logger.info(f"Exporting {model_id} to ONNX...")
+        model = ORTModelForSpeechSeq2Seq.from_pretrained(model_id, export=True, use_cache=True)
+        model.save_pretrained(export_dir)
+
+        # Dynamic INT8 quantization dispatches to VNNI int8 GEMMs on x86
+        quantization_config = AutoQuantizationConfig.avx512_vnni(
+            is_static=False, per_channel=True
+        )
+        for file_name in sorted(os.listdir(export_dir)):
+            if not file_name.endswith(".onnx"):
+                continue
+            logger.info(f"Quantizing {file_name}...")
+            quantizer = ORTQuantizer.from_pretrained(export_dir, file_name=file_name)
+            quantizer.quantize(save_dir=save_dir, quantization_config=quantization_config)
+
+    model.generation_config.save_pretrained(save_dir)
+    AutoProcessor.from_pretrained(model_id).save_pretrained(save_dir)
+    logger.info(f"INT8 ONNX model saved to {save_dir}")
+
+
+if __name__ == "__main__":
+    export_onnx_int8()
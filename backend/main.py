@@ -1,16 +1,21 @@
 import asyncio
+import concurrent.futures
+import json
 import logging
 import os
+import platform
+import shutil
+import subprocess
 import tempfile
 import time
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-import ffmpeg
+import aiofiles
 import io
-from transcription_wrapper import TranscriptionWrapper, MLX_AVAILABLE
+from transcription_wrapper import SAMPLING_RATE, TranscriptionWrapper, MLX_AVAILABLE, load_audio
 
 # Configure logging
 logging.basicConfig(
@@ -19,8 +24,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Global variable to hold the transcription wrapper
-transcription_wrapper = None
+# Concurrent requests arriving within this window are fused into one batch
+BATCH_WINDOW_S = 0.025
+MAX_BATCH_SIZE = 8
+
+# Strong references to fire-and-forget cleanup tasks
+background_tasks = set()
+
+# Reusable upload files, held by a request only until its audio is decoded
+TMP_POOL_SIZE = 2 * MAX_BATCH_SIZE
+
+# Size of each read when streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+# Zero-copy upload spool -> temp file copies are only used on Linux
+USE_SENDFILE = platform.system() == "Linux" and hasattr(os, "sendfile")
 
 
 class TranscriptRequest(BaseModel):
@@ -31,15 +49,130 @@ class SRTRequest(BaseModel):
     srt_transcript: str
 
 
+def run_transcription_batch(batch, transcription_wrapper, loop) -> None:
+    """Transcribe a batch on the worker thread, pushing events to each request's queue"""
+    def emit(events, event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    if transcription_wrapper.supports_batching:
+        # Segments of a fused batch are only available once the whole batch finishes
+        start_time = time.time()
+        try:
+            segments_per_file = transcription_wrapper.transcribe_batch(
+                [audio for audio, _ in batch]
+            )
+        except Exception as e:
+            for _, events in batch:
+                emit(events, ("error", e))
+            return
+        batch_time = time.time() - start_time
+        # Attribute the fused batch's wall time to each file by its share of the
+        # audio, so one file's real-time factor is not inflated by the others
+        total_samples = sum(len(audio) for audio, _ in batch)
+        for (audio, events), segments in zip(batch, segments_per_file):
+            share = len(audio) / total_samples if total_samples else 1 / len(batch)
+            for segment in segments:
+                emit(events, ("segment", segment))
+            emit(events, ("done", (batch_time * share, len(audio) / SAMPLING_RATE, len(batch))))
+        return
+
+    # Single-file backends forward segments as transcribe() yields them
+    for audio, events in batch:
+        start_time = time.time()
+        try:
+            for segment in transcription_wrapper.transcribe(audio):
+                emit(events, ("segment", segment))
+        except Exception as e:
+            emit(events, ("error", e))
+            continue
+        emit(events, ("done", (time.time() - start_time, len(audio) / SAMPLING_RATE, 1)))
+
+
+async def transcription_batcher(queue: asyncio.Queue, executor, transcription_wrapper):
+    """Drain queued (decoded audio, event queue) pairs and transcribe them in batches"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        max_batch = MAX_BATCH_SIZE if transcription_wrapper.supports_batching else 1
+        deadline = loop.time() + BATCH_WINDOW_S
+        while len(batch) < max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        logger.debug("Dispatching batch of %d", len(batch))
+        await loop.run_in_executor(
+            executor, run_transcription_batch, batch, transcription_wrapper, loop
+        )
+
+
+def load_transcription_wrapper() -> TranscriptionWrapper:
+    logger.info("Initializing Transcription Wrapper...")
+    try:
+        wrapper = TranscriptionWrapper()
+        wrapper.warmup()
+    except Exception as e:
+        logger.error(f"Error initializing Transcription Wrapper: {e}")
+        raise
+    logger.info("Transcription Wrapper ready.")
+    return wrapper
+
+
+def unavailable_message() -> str:
+    """Explain why app.state.transcription_wrapper is not set yet"""
+    if app.state.load_task.done():
+        return "Transcription model failed to load. Please check server logs."
+    return "Transcription model is loading."
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Load the transcription pipeline on startup
-    global transcription_wrapper
-    logger.info("Initializing Transcription Wrapper...")
-    transcription_wrapper = TranscriptionWrapper()
-    yield
-    # Clean up resources if any
-    logger.info("Application shutdown.")
+    # Single worker so requests queue behind the one accelerator
+    app.state.transcribe_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="whisper"
+    )
+    app.state.transcribe_queue = asyncio.Queue()
+    app.state.tmp_dir = tempfile.mkdtemp(prefix="whisper_")
+    app.state.tmp_pool = asyncio.Queue()
+    for i in range(TMP_POOL_SIZE):
+        app.state.tmp_pool.put_nowait(os.path.join(app.state.tmp_dir, f"whisper_{i}.bin"))
+
+    # Set once the load succeeds; requests are rejected with 503 until then
+    app.state.transcription_wrapper = None
+    app.state.batcher_task = None
+
+    def on_loaded(load_task):
+        if load_task.cancelled() or load_task.exception() is not None:
+            return
+        app.state.transcription_wrapper = load_task.result()
+        app.state.batcher_task = asyncio.create_task(
+            transcription_batcher(
+                app.state.transcribe_queue,
+                app.state.transcribe_executor,
+                app.state.transcription_wrapper,
+            )
+        )
+
+    # Load the model on the transcription thread so the server can answer
+    # health checks while the weights download and the warmup runs
+    app.state.load_task = asyncio.get_running_loop().run_in_executor(
+        app.state.transcribe_executor, load_transcription_wrapper
+    )
+    app.state.load_task.add_done_callback(on_loaded)
+    try:
+        yield
+    finally:
+        # Clean up resources if any
+        if app.state.batcher_task is not None:
+            app.state.batcher_task.cancel()
+        await asyncio.gather(app.state.load_task, return_exceptions=True)
+        app.state.transcribe_executor.shutdown(wait=True)
+        shutil.rmtree(app.state.tmp_dir, ignore_errors=True)
+        logger.info("Application shutdown.")
 
 
 app = FastAPI(lifespan=lifespan)
@@ -60,92 +193,49 @@ app.add_middleware(
 )
 
 
-def get_audio_duration(file_path: str) -> float:
-    """Get audio duration in seconds using multiple methods"""
-    # Method 1: Try ffmpeg probe with detailed debugging
-    try:
-        probe = ffmpeg.probe(file_path)
-        print(f"Debug: ffmpeg probe keys: {list(probe.keys())}")
-
-        # Try format duration first
-        if "format" in probe and "duration" in probe["format"]:
-            duration = float(probe["format"]["duration"])
-            print(f"Found duration in format: {duration:.2f}s")
-            return duration
-
-        # Try streams duration
-        if "streams" in probe:
-            print(f"Debug: Found {len(probe['streams'])} streams")
-            for i, stream in enumerate(probe["streams"]):
-                print(f"Debug: Stream {i} keys: {list(stream.keys())}")
-                if "duration" in stream:
-                    duration = float(stream["duration"])
-                    print(f"Found duration in stream {i}: {duration:.2f}s")
-                    return duration
-
-        # Try to calculate from bitrate and size
-        if "format" in probe:
-            format_data = probe["format"]
-            print(f"Debug: Format keys: {list(format_data.keys())}")
-            if "size" in format_data and "bit_rate" in format_data:
-                size_bytes = int(format_data["size"])
-                bitrate = int(format_data["bit_rate"])
-                if bitrate > 0:
-                    duration = (size_bytes * 8) / bitrate
-                    print(f"Calculated duration from bitrate: {duration:.2f}s")
-                    return duration
-
-        print("Could not find duration in any probe data")
+def reset_temp_file(file_path: str) -> None:
+    # Truncate (or recreate) the file so it can be reused by the next request
+    with open(file_path, "wb"):
+        pass
 
-    except Exception as e:
-        print(f"Error with ffmpeg probe: {e}")
 
-    # Method 2: Try using ffmpeg duration command directly
-    try:
-        result = (
-            os.popen(
-                f'ffprobe -v quiet -show_entries format=duration -of csv="p=0" "{file_path}"'
-            )
-            .read()
-            .strip()
-        )
-        if result and result != "N/A":
-            duration = float(result)
-            print(f"Found duration using ffprobe command: {duration:.2f}s")
-            return duration
-    except Exception as e:
-        print(f"Error with ffprobe command: {e}")
+async def release_temp_file(file_path: str) -> None:
+    """Return a pooled temp file once its audio has been decoded"""
+    await asyncio.to_thread(reset_temp_file, file_path)
+    app.state.tmp_pool.put_nowait(file_path)
 
-    # Method 3: Try estimating from file size (very rough)
-    try:
-        file_size = os.path.getsize(file_path)
-        # For compressed audio, estimate based on typical compression ratios
-        # WebM/OGG typically compress to about 64-128kbps
-        estimated_duration = (file_size * 8) / (96 * 1024)  # Assume 96kbps average
-        print(
-            f"Fallback estimate from file size ({file_size} bytes): {estimated_duration:.2f}s"
-        )
-        return estimated_duration
-    except Exception as e:
-        print(f"Fallback estimation failed: {e}")
-        return 0.0
+
+def spawn_background(coro) -> None:
+    """Run a coroutine without awaiting it, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def sendfile_upload(src, dst_fd: int) -> None:
+    """Copy a disk-backed upload spool to dst_fd with zero-copy sendfile"""
+    src_fd = src.fileno()
+    size = os.fstat(src_fd).st_size
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+        if sent == 0:
+            break
+        offset += sent
 
 
 @app.post("/transcribe/")
 async def transcribe_audio(
     file: UploadFile = File(...), audio_duration_hint: float = None
 ):
+    transcription_wrapper = app.state.transcription_wrapper
     if transcription_wrapper is None:
+        raise HTTPException(status_code=503, detail=unavailable_message())
+
+    if transcription_wrapper.model is None:
         raise HTTPException(
             status_code=503,
-            detail="Transcription service is not available. Please check server logs.",
-        )
-    
-    # For MLX inference, we don't need a pre-loaded model
-    if transcription_wrapper.device != "mps" and transcription_wrapper.model is None:
-        raise HTTPException(
-            status_code=503,
-            detail="Transcription service is not available. Please check server logs.",
+            detail="Transcription model failed to load. Please check server logs.",
         )
 
     if not file.content_type.startswith("audio/"):
@@ -153,63 +243,92 @@ async def transcribe_audio(
             status_code=400, detail="Invalid file type. Please upload an audio file."
         )
 
-    tmp_audio_file_path = None
+    # ffmpeg detects the container from its header, so a fixed name is fine
+    tmp_audio_file_path = await app.state.tmp_pool.get()
     try:
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=os.path.splitext(file.filename)[1]
-        ) as tmp_audio_file:
-            content = await file.read()
-            tmp_audio_file.write(content)
-            tmp_audio_file_path = tmp_audio_file.name
-
-        audio_duration = (
-            audio_duration_hint
-            if audio_duration_hint and audio_duration_hint > 0
-            else get_audio_duration(tmp_audio_file_path)
+        async with aiofiles.open(tmp_audio_file_path, "wb") as tmp_audio_file:
+            if USE_SENDFILE and getattr(file.file, "_rolled", False):
+                # The upload spool is already on disk: copy it inside the kernel
+                await asyncio.to_thread(
+                    sendfile_upload, file.file, tmp_audio_file.fileno()
+                )
+            else:
+                # Stream the upload to disk in fixed-size chunks to keep memory constant
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    await tmp_audio_file.write(chunk)
+        # Decode before responding so bad uploads fail with a status code
+        # instead of an error line in a 200 stream
+        audio = await asyncio.to_thread(load_audio, tmp_audio_file_path)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error decoding uploaded audio: {e.stderr.decode(errors='replace').strip()}")
+        raise HTTPException(
+            status_code=400, detail="Could not decode the uploaded audio file."
         )
-
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: transcription_wrapper.transcribe(tmp_audio_file_path),
+    except Exception as e:
+        logger.error(f"Error saving uploaded audio: {e}")
+        raise HTTPException(
+            status_code=500, detail=f"Error during transcription: {str(e)}"
         )
-
-        inference_time = result["inference_time"]
-        full_text = result["text"]
-        srt_transcript = result["srt_transcript"]
+    finally:
+        spawn_background(release_temp_file(tmp_audio_file_path))
+
+    events = asyncio.Queue()
+    await app.state.transcribe_queue.put((audio, events))
+    return StreamingResponse(
+        stream_transcription(events, transcription_wrapper, audio_duration_hint),
+        media_type="application/x-ndjson",
+    )
+
+
+async def stream_transcription(events: asyncio.Queue, transcription_wrapper, audio_duration_hint):
+    """Yield one NDJSON line per segment, followed by a benchmark (or error) line"""
+    n_segments = 0
+    while True:
+        kind, payload = await events.get()
+        if kind == "segment":
+            start_time, end_time, text = payload
+            n_segments += 1
+            yield json.dumps(
+                {"start": start_time, "end": end_time, "text": text}, ensure_ascii=False
+            ) + "\n"
+            continue
+
+        if kind == "error":
+            logger.error(f"Error during transcription: {payload}")
+            yield json.dumps({"error": f"Error during transcription: {payload}"}) + "\n"
+            return
+
+        inference_time, decoded_duration, batch_size = payload
+        # The decoded sample count gives the duration unless the client sent one
+        if audio_duration_hint and audio_duration_hint > 0:
+            audio_duration = audio_duration_hint
+        else:
+            audio_duration = decoded_duration
 
         real_time_factor = (
             inference_time / audio_duration if audio_duration > 0 else 0
         )
 
+        # batch_size is how many requests were transcribed together; for a fused
+        # batch inference_time_seconds (and so real_time_factor) is this file's
+        # share of the batch's wall time, in proportion to its audio length
         benchmark = {
             "audio_duration_seconds": round(audio_duration, 2) if audio_duration > 0 else "unknown",
             "inference_time_seconds": round(inference_time, 2),
+            "batch_size": batch_size,
             "real_time_factor": round(real_time_factor, 2) if real_time_factor > 0 else "unknown",
             "device": transcription_wrapper.device,
+            "backend": transcription_wrapper.backend,
             "model": "Whisper-large-v3-turbo"
         }
 
-        logger.info(f"Transcription completed: {len(full_text)} characters, "
-                    f"{len(srt_transcript)} SRT characters, "
-                    f"Inference time: {inference_time:.2f} seconds, "
+        logger.info(f"Transcription completed: {n_segments} segments, "
+                    f"Inference time: {inference_time:.2f} seconds (batch of {batch_size}), "
                     f"Real-time factor: {real_time_factor:.2f}, "
                     f"Audio duration: {audio_duration:.2f} seconds")
 
-        return {
-            "transcript": full_text,
-            "srt_transcript": srt_transcript,
-            "benchmark": benchmark,
-        }
-
-    except Exception as e:
-        logger.error(f"Error during transcription: {e}")
-        raise HTTPException(
-            status_code=500, detail=f"Error during transcription: {str(e)}"
-        )
-    finally:
-        if tmp_audio_file_path and os.path.exists(tmp_audio_file_path):
-            os.remove(tmp_audio_file_path)
+        yield json.dumps({"benchmark": benchmark}) + "\n"
+        return
 
 
 @app.post("/download-transcript/")
@@ -258,11 +377,18 @@ async def download_srt(request: SRTRequest):
 
 @app.get("/")
 async def root():
+    transcription_wrapper = app.state.transcription_wrapper
     device_info = {
         "device": transcription_wrapper.device if transcription_wrapper else "unknown",
+        "backend": transcription_wrapper.backend if transcription_wrapper else None,
         "mlx_available": MLX_AVAILABLE,
-        "hugging_face_available": transcription_wrapper.model is not None if transcription_wrapper else False,
+        "hugging_face_available": transcription_wrapper.backend == "hugging_face" if transcription_wrapper else False,
     }
+    if transcription_wrapper is None:
+        return JSONResponse(
+            status_code=503,
+            content={"message": unavailable_message(), "device_info": device_info},
+        )
     return {
         "message": "Whisper ASR API with SRT support and benchmarking is running. Use the /transcribe endpoint to process audio.",
         "device_info": device_info,
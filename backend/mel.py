@@ -0,0 +1,69 @@
+import numpy as np
+
+# Conditional import for Numba
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Whisper front-end constants: 16 kHz, 30 s chunks, 25 ms window, 10 ms hop
+N_FFT = 400
+HOP_LENGTH = 160
+N_SAMPLES = 16000 * 30
+N_FRAMES = N_SAMPLES // HOP_LENGTH  # 3000
+N_FREQS = N_FFT // 2 + 1  # 201
+
+# Periodic Hann window and real DFT basis, hoisted out of the kernel
+_WINDOW = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(N_FFT) / N_FFT)).astype(np.float32)
+_ANGLES = 2 * np.pi * np.outer(np.arange(N_FFT), np.arange(N_FREQS)) / N_FFT
+_DFT_COS = np.ascontiguousarray(np.cos(_ANGLES) * _WINDOW[:, None], dtype=np.float32)
+_DFT_SIN = np.ascontiguousarray(np.sin(_ANGLES) * _WINDOW[:, None], dtype=np.float32)
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _log_mel_kernel(audio_chunks, dft_cos, dft_sin, mel_filters):
+        n_chunks = audio_chunks.shape[0]
+        n_mels = mel_filters.shape[1]
+        pad = N_FFT // 2
+        out = np.empty((n_chunks, n_mels, N_FRAMES), dtype=np.float32)
+        for c in prange(n_chunks):
+            # Reflect-pad like a centered STFT
+            x = audio_chunks[c]
+            padded = np.empty(N_SAMPLES + 2 * pad, dtype=np.float32)
+            padded[pad:pad + N_SAMPLES] = x
+            for i in range(pad):
+                padded[pad - 1 - i] = x[i + 1]
+                padded[pad + N_SAMPLES + i] = x[N_SAMPLES - 2 - i]
+
+            # The last STFT frame is dropped, as in Whisper
+            frames = np.empty((N_FRAMES, N_FFT), dtype=np.float32)
+            for t in range(N_FRAMES):
+                frames[t] = padded[t * HOP_LENGTH:t * HOP_LENGTH + N_FFT]
+
+            real = frames @ dft_cos
+            imag = frames @ dft_sin
+            mel = (real * real + imag * imag) @ mel_filters
+
+            log_spec = np.log10(np.maximum(mel, 1e-10))
+            log_spec = np.maximum(log_spec, log_spec.max() - 8.0)
+            out[c] = ((log_spec + 4.0) / 4.0).T
+        return out
+
+
+def log_mel_spectrogram(audio_chunks, mel_filters):
+    """Compute [N, n_mels, 3000] log-mel features for [N, 480000] chunks of 30 s audio"""
+    # mel_filters is the (201, n_mels) bank of the model's feature extractor
+    audio_chunks = np.ascontiguousarray(audio_chunks, dtype=np.float32)
+    mel_filters = np.ascontiguousarray(mel_filters, dtype=np.float32)
+    # The kernel hard-codes these sizes and does no bounds checking
+    if audio_chunks.ndim != 2 or audio_chunks.shape[1] != N_SAMPLES:
+        raise ValueError(
+            f"Expected audio chunks of shape [N, {N_SAMPLES}], got {audio_chunks.shape}"
+        )
+    if mel_filters.ndim != 2 or mel_filters.shape[0] != N_FREQS:
+        raise ValueError(
+            f"Expected mel filters of shape [{N_FREQS}, n_mels], got {mel_filters.shape}"
+        )
+    return _log_mel_kernel(audio_chunks, _DFT_COS, _DFT_SIN, mel_filters)
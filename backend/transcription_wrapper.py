@@ -1,8 +1,12 @@
+import gc
+import os
+import subprocess
+import numpy as np
 import torch
 import time
 import logging
-from datetime import timedelta
-import srt
+from config import CPU_BACKEND, ONNX_MODEL_DIR
+from mel import NUMBA_AVAILABLE, log_mel_spectrogram
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -11,23 +15,113 @@ logger = logging.getLogger(__name__)
 try:
     import mlx.core as mx
     import mlx_whisper
-    from mlx_whisper import load_models
+    from mlx_whisper.transcribe import ModelHolder
     MLX_AVAILABLE = True
 except ImportError:
     MLX_AVAILABLE = False
 
+# Conditional import for faster-whisper (CTranslate2)
+try:
+    from faster_whisper import WhisperModel
+    FASTER_WHISPER_AVAILABLE = True
+except ImportError:
+    FASTER_WHISPER_AVAILABLE = False
+
+# Conditional import for whisper.cpp bindings
+try:
+    from pywhispercpp.model import Model as WhisperCppModel
+    WHISPER_CPP_AVAILABLE = True
+except ImportError:
+    WHISPER_CPP_AVAILABLE = False
+
 # Conditional import for Hugging Face
 try:
-    from transformers import pipeline
+    from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor
     HUGGING_FACE_AVAILABLE = True
 except ImportError:
     HUGGING_FACE_AVAILABLE = False
 
+# Conditional import for ONNX Runtime via optimum
+try:
+    from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+    from transformers import pipeline
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+# Conditional import for HQQ quantization
+try:
+    from hqq.core.quantize import BaseQuantizeConfig
+    from hqq.models.hf.base import AutoHQQHFModel
+    HQQ_AVAILABLE = True
+except ImportError:
+    HQQ_AVAILABLE = False
+
+SAMPLING_RATE = 16000
+CHUNK_LENGTH_S = 30
+CHUNK_SIZE = SAMPLING_RATE * CHUNK_LENGTH_S  # samples per 30 s chunk
+STRIDE_LENGTH_S = CHUNK_LENGTH_S / 6  # overlap on each side of a chunk, as in the HF pipeline
+STRIDE_SIZE = int(SAMPLING_RATE * STRIDE_LENGTH_S)
+# 30 s chunks per generate call; a partial slice is padded up to the next size
+# so the static cache and compiled graphs only ever see these shapes
+GENERATE_BATCH_SIZES = (1, 2, 4, 8, 16)
+MAX_GENERATE_BATCH_SIZE = GENERATE_BATCH_SIZES[-1]
+
+def _clean_segments(segments, duration):
+    """Drop whitespace-only segments, ending an open final segment at the audio duration"""
+    for start_time, end_time, text in segments:
+        if not text.strip():
+            continue
+        # Timestamped pipelines leave the end open when the audio stops mid-segment
+        if end_time is None:
+            end_time = duration
+        yield start_time, end_time, text
+
+def load_audio(audio_path):
+    """Decode an audio file to a 16 kHz mono float32 array with a single ffmpeg call"""
+    proc = subprocess.run(
+        [
+            "ffmpeg", "-nostdin", "-v", "error",
+            "-i", audio_path,
+            "-f", "f32le", "-ac", "1", "-ar", str(SAMPLING_RATE),
+            "-",
+        ],
+        capture_output=True,
+        check=True,
+    )
+    return np.frombuffer(proc.stdout, dtype=np.float32)
+
+def _tile_audio(audio):
+    """Cut audio into zero-padded, overlapping 30 s chunks like the HF pipeline's chunk_iter
+
+    Returns the [N, CHUNK_SIZE] chunks and each chunk's (length, left stride,
+    right stride) in seconds, which the tokenizer uses to merge the overlaps.
+    """
+    step = CHUNK_SIZE - 2 * STRIDE_SIZE
+    chunks, strides = [], []
+    for start in range(0, len(audio), step):
+        chunk = audio[start:start + CHUNK_SIZE]
+        is_last = start + CHUNK_SIZE >= len(audio)
+        chunks.append(np.pad(chunk, (0, CHUNK_SIZE - len(chunk))))
+        strides.append((
+            len(chunk) / SAMPLING_RATE,
+            0 if start == 0 else STRIDE_LENGTH_S,
+            0 if is_last else STRIDE_LENGTH_S,
+        ))
+        if is_last:
+            break
+    return np.array(chunks, dtype=np.float32).reshape(-1, CHUNK_SIZE), strides
+
 class TranscriptionWrapper:
     def __init__(self):
         self.device = self._get_device()
-        self.model = self._load_model()
+        self.backend = None  # One of "mlx", "faster_whisper", "whisper_cpp", "onnx", "hugging_face"
+        self.processor = None  # Hugging Face processor, set by the HF loader
+        self.mel_filters = None  # (201, n_mels) filter bank for the Numba mel kernel
+        self.torch_dtype = torch.float16 if self.device == "mps" else torch.float32
         self.model_name = "mlx-community/whisper-large-v3-turbo"  # Store model name for MLX
+        self._static_caches = {}  # batch size -> static cache reused by generate
+        self.model = self._load_model()
 
     def _get_device(self):
         if MLX_AVAILABLE and torch.backends.mps.is_available():
@@ -38,108 +132,335 @@ class TranscriptionWrapper:
         logger.info(f"Using device: {self.device}")
         if self.device == "mps" and MLX_AVAILABLE:
             try:
-                logger.info("Directly use MLX.")
+                logger.info("Loading MLX Whisper model...")
+                # ModelHolder caches the weights, so mlx_whisper.transcribe reuses
+                # them instead of resolving the repo on every request
+                model = ModelHolder.get_model(self.model_name, mx.float16)
+                logger.info(f"MLX Whisper model ({self.model_name}) loaded successfully.")
+                self.backend = "mlx"
+                return model
             except Exception as e:
                 logger.error(f"Error loading MLX Whisper model: {e}")
                 logger.info("Falling back to Hugging Face model...")
                 return self._load_hugging_face_model()
         else:
-            return self._load_hugging_face_model()
+            return self._load_cpu_model()
+
+    def _load_cpu_model(self):
+        # name -> (usable, loader), in the order tried when WHISPER_CPU_BACKEND is unset
+        loaders = {
+            "faster_whisper": (FASTER_WHISPER_AVAILABLE, self._load_faster_whisper_model),
+            "whisper_cpp": (WHISPER_CPP_AVAILABLE, self._load_whisper_cpp_model),
+            "onnx": (ONNX_AVAILABLE and os.path.isdir(ONNX_MODEL_DIR), self._load_onnx_model),
+        }
+        if CPU_BACKEND in loaders:
+            candidates = [CPU_BACKEND]
+        elif CPU_BACKEND == "hugging_face":
+            candidates = []
+        else:
+            if CPU_BACKEND is not None:
+                logger.warning(f"Unknown WHISPER_CPU_BACKEND '{CPU_BACKEND}', using the default order.")
+            candidates = list(loaders)
+
+        for name in candidates:
+            usable, load = loaders[name]
+            if not usable:
+                logger.info(f"Skipping {name} backend: not installed or not exported.")
+                continue
+            model = load()
+            if model is not None:
+                return model
+        logger.info("Falling back to Hugging Face model...")
+        return self._load_hugging_face_model()
+
+    def _load_faster_whisper_model(self):
+        logger.info("Loading faster-whisper model (CTranslate2, INT8)...")
+        model_id = "large-v3-turbo"
+        try:
+            model = WhisperModel(model_id, device="cpu", compute_type="int8")
+            logger.info(f"faster-whisper model ({model_id}) loaded successfully.")
+            self.backend = "faster_whisper"
+            return model
+        except Exception as e:
+            logger.error(f"Error loading faster-whisper model: {e}")
+            return None
+
+    def _load_whisper_cpp_model(self):
+        logger.info("Loading whisper.cpp model (Q5_0)...")
+        model_id = "large-v3-turbo-q5_0"
+        try:
+            model = WhisperCppModel(
+                model_id, n_threads=os.cpu_count(), print_realtime=False
+            )
+            logger.info(f"whisper.cpp model ({model_id}) loaded successfully.")
+            self.backend = "whisper_cpp"
+            return model
+        except Exception as e:
+            logger.error(f"Error loading whisper.cpp model: {e}")
+            return None
+
+    def _load_onnx_model(self):
+        logger.info("Loading ONNX Runtime model (INT8)...")
+        try:
+            model = ORTModelForSpeechSeq2Seq.from_pretrained(
+                ONNX_MODEL_DIR, provider="CPUExecutionProvider"
+            )
+            processor = AutoProcessor.from_pretrained(ONNX_MODEL_DIR)
+            transcription_pipeline = pipeline(
+                "automatic-speech-recognition",
+                model=model,
+                feature_extractor=processor.feature_extractor,
+                tokenizer=processor.tokenizer,
+            )
+            logger.info(f"ONNX Runtime model ({ONNX_MODEL_DIR}) loaded successfully.")
+            self.backend = "onnx"
+            return transcription_pipeline
+        except Exception as e:
+            logger.error(f"Error loading ONNX Runtime model: {e}")
+            return None
 
     def _load_hugging_face_model(self):
         if not HUGGING_FACE_AVAILABLE:
             logger.warning("Hugging Face transformers not available.")
             return None
 
-        logger.info("Loading Hugging Face transcription pipeline...")
-        torch_dtype = torch.float16 if self.device == "mps" else torch.float32
+        logger.info("Loading Hugging Face transcription model...")
         model_id = "openai/whisper-large-v3-turbo"
         try:
-            transcription_pipeline = pipeline(
-                "automatic-speech-recognition",
-                model=model_id,
-                torch_dtype=torch_dtype,
-                device=self.device,
+            self.processor = AutoProcessor.from_pretrained(model_id)
+            self.mel_filters = self.processor.feature_extractor.mel_filters
+            model = self._quantize_hqq(self._load_fp_model(model_id), model_id)
+
+            # Static KV cache + compiled forward avoids re-allocating the cache
+            # and dispatching many small ops on every decoding step.
+            model.generation_config.cache_implementation = "static"
+            model.generation_config.max_new_tokens = 440
+            # Kept so warmup can fall back if compilation fails
+            self._eager_forward = model.forward
+            model.forward = torch.compile(
+                model.forward, mode="reduce-overhead", fullgraph=True
             )
-            logger.info(f"Hugging Face pipeline ({model_id}) loaded successfully.")
-            return transcription_pipeline
+            logger.info(f"Hugging Face model ({model_id}) loaded successfully.")
+            self.backend = "hugging_face"
+            return model
         except Exception as e:
             logger.error(f"Error loading Hugging Face model: {e}")
             return None
 
-    def transcribe(self, audio_path):
-        is_mlx = self.device == "mps" and MLX_AVAILABLE
-        if self.model is None and not is_mlx:
-            raise RuntimeError("Transcription model not loaded.")
+    def _load_fp_model(self, model_id):
+        return AutoModelForSpeechSeq2Seq.from_pretrained(
+            model_id,
+            torch_dtype=self.torch_dtype,
+            attn_implementation="sdpa",
+        ).to(self.device)
+
+    def _quantize_hqq(self, model, model_id):
+        """Quantize linear layers to INT4, returning freshly loaded FP weights if HQQ fails"""
+        if not HQQ_AVAILABLE:
+            logger.info("HQQ not available, using unquantized weights.")
+            return model
+        try:
+            AutoHQQHFModel.quantize_model(
+                model,
+                quant_config=BaseQuantizeConfig(nbits=4, group_size=64),
+                compute_dtype=self.torch_dtype,
+                device=self.device,
+            )
+            # Missing kernels usually only fail on the first forward pass
+            self._check_forward(model)
+            logger.info("Quantized Hugging Face model to INT4 with HQQ.")
+            return model
+        except Exception as e:
+            logger.warning(f"HQQ quantization failed, reloading unquantized weights: {e}")
+
+        # The model may be partially quantized in place, so reload it. This runs
+        # outside the except block: the traceback's frames still reference the
+        # old model there, and reloading would hold two copies in memory
+        del model
+        gc.collect()
+        return self._load_fp_model(model_id)
+
+    def _check_forward(self, model):
+        """Run one encoder + decoder step on silence to surface kernel errors at load time"""
+        n_mels = self.processor.feature_extractor.feature_size
+        input_features = torch.zeros(
+            (1, n_mels, CHUNK_SIZE // self.processor.feature_extractor.hop_length),
+            dtype=self.torch_dtype,
+            device=self.device,
+        )
+        decoder_input_ids = torch.tensor(
+            [[model.config.decoder_start_token_id]], device=self.device
+        )
+        with torch.inference_mode():
+            model(input_features=input_features, decoder_input_ids=decoder_input_ids)
 
+    def warmup(self):
+        """Run a dummy generate per batch size so torch.compile cost is paid at startup"""
+        if self.backend != "hugging_face":
+            return
+        logger.info("Warming up Hugging Face model...")
         start_time = time.time()
-        if self.device == "mps" and MLX_AVAILABLE:
-            # Use MLX Whisper with pre-loaded model
-            logger.info("Transcribing with MLX Whisper...")
-            # Fallback to using model name
-            result = mlx_whisper.transcribe(
-                audio_path,
-                path_or_hf_repo=self.model_name,
-                word_timestamps=True
+        try:
+            for batch_size in GENERATE_BATCH_SIZES:
+                list(self._generate_chunks(np.zeros((batch_size, CHUNK_SIZE), dtype=np.float32)))
+        except Exception as e:
+            # Retry eagerly with a dynamic cache; a second failure fails the load
+            logger.warning(f"Compiled warmup failed, falling back to eager forward: {e}")
+            self.model.forward = self._eager_forward
+            self.model.generation_config.cache_implementation = None
+            self._static_caches.clear()
+            list(self._generate_chunks(np.zeros((1, CHUNK_SIZE), dtype=np.float32)))
+        logger.info(f"Warmup finished in {time.time() - start_time:.2f} seconds.")
+
+    def _generate_chunks(self, audio_chunks):
+        """Transcribe an [N, 480000] array of 30 s chunks, yielding generated token ids per chunk"""
+        # Pad the trailing partial slice with silence up to a warmed-up batch size
+        n_chunks = len(audio_chunks)
+        tail = n_chunks % MAX_GENERATE_BATCH_SIZE
+        if tail:
+            padded_tail = next(size for size in GENERATE_BATCH_SIZES if size >= tail)
+            audio_chunks = np.concatenate(
+                [audio_chunks, np.zeros((padded_tail - tail, CHUNK_SIZE), dtype=audio_chunks.dtype)]
             )
-            
-            text = result["text"]
-            segments = result["segments"]
-            srt_transcript = self._format_as_srt_from_segments(segments)
-            chunks = segments
 
+        # One vectorized feature extraction for every chunk -> [N, n_mels, 3000]
+        if NUMBA_AVAILABLE:
+            input_features = torch.from_numpy(
+                log_mel_spectrogram(audio_chunks, self.mel_filters)
+            )
         else:
-            # Use Hugging Face pipeline
-            result = self.model(
-                audio_path,
-                return_timestamps=True,
-                chunk_length_s=30,
+            input_features = self.processor(
+                audio_chunks, sampling_rate=SAMPLING_RATE, return_tensors="pt"
+            ).input_features
+
+        for i in range(0, len(input_features), MAX_GENERATE_BATCH_SIZE):
+            # generate runs the encoder once over the whole slice of chunks
+            batch = input_features[i:i + MAX_GENERATE_BATCH_SIZE].to(
+                self.device, dtype=self.torch_dtype
             )
-            text = result["text"]
-            chunks = result.get("chunks", [])
-            srt_transcript = self._format_as_srt_from_chunks(chunks)
+            with torch.inference_mode():
+                predicted_ids = self._generate(batch)
+            # Outputs for the silence padding are dropped
+            yield from predicted_ids.cpu()[:n_chunks - i]
 
-        end_time = time.time()
-        inference_time = end_time - start_time
+    def _generate(self, input_features):
+        """Call generate with the static cache kept for this batch size"""
+        # generate reallocates its cache whenever the batch size differs from the
+        # last call, so keep one per size and swap it in
+        static = self.model.generation_config.cache_implementation == "static"
+        batch_size = len(input_features)
+        if static and batch_size in self._static_caches:
+            self.model._cache = self._static_caches[batch_size]
+        predicted_ids = self.model.generate(input_features, return_timestamps=True)
+        if static and hasattr(self.model, "_cache"):
+            self._static_caches[batch_size] = self.model._cache
+        return predicted_ids
 
-        return {
-            "text": text,
-            "srt_transcript": srt_transcript,
-            "inference_time": inference_time,
-            "chunks": chunks,
-        }
+    def _transcribe_hugging_face(self, audios):
+        """Transcribe several decoded audios with fused generate calls, yielding (audio index, segment)"""
+        tiled = [_tile_audio(audio) for audio in audios]
+        chunk_owners = [
+            (file_idx, stride)
+            for file_idx, (_, file_strides) in enumerate(tiled)
+            for stride in file_strides
+        ]
+        if not chunk_owners:
+            return
 
-    def _format_as_srt_from_chunks(self, chunks):
-        srt_content = []
-        for i, chunk in enumerate(chunks):
-            timestamp = chunk.get("timestamp")
-            if not timestamp or len(timestamp) != 2:
-                continue
+        model_outputs = [[] for _ in audios]
+        decoded = self._generate_chunks(np.concatenate([tiles for tiles, _ in tiled]))
+        for (file_idx, stride), token_ids in zip(chunk_owners, decoded):
+            model_outputs[file_idx].append({"tokens": token_ids[None], "stride": stride})
 
-            start_time, end_time = timestamp
-            if start_time is None or end_time is None:
+        # Merge the overlapping chunks of each file exactly like the ASR pipeline
+        time_precision = CHUNK_LENGTH_S / self.model.config.max_source_positions
+        for file_idx, outputs in enumerate(model_outputs):
+            if not outputs:
                 continue
+            _, merged = self.processor.tokenizer._decode_asr(
+                outputs,
+                return_timestamps=True,
+                return_language=False,
+                time_precision=time_precision,
+            )
+            for chunk in merged["chunks"]:
+                start_time, end_time = chunk["timestamp"]
+                yield file_idx, (start_time, end_time, chunk["text"])
+
+    @property
+    def supports_batching(self):
+        # Only the Hugging Face model path fuses several files into one generate call
+        return self.backend == "hugging_face"
+
+    def transcribe_batch(self, audios):
+        """Transcribe several decoded audios, returning one segment list per audio"""
+        if not self.supports_batching:
+            return [list(self.transcribe(audio)) for audio in audios]
+        if self.model is None:
+            raise RuntimeError("Transcription model not loaded.")
+
+        logger.debug("Transcribing batch of %d with Hugging Face model...", len(audios))
+        segments_per_file = [[] for _ in audios]
+        for file_idx, segment in self._transcribe_hugging_face(audios):
+            segments_per_file[file_idx].append(segment)
+        return [
+            list(_clean_segments(segments, len(audio) / SAMPLING_RATE))
+            for audio, segments in zip(audios, segments_per_file)
+        ]
+
+    def transcribe(self, audio):
+        """Transcribe a 16 kHz mono array with a single-file backend, yielding (start, end, text)"""
+        if self.model is None:
+            raise RuntimeError("Transcription model not loaded.")
+
+        if self.backend == "mlx":
+            # Use MLX Whisper; the model name resolves to the preloaded weights
+            logger.debug("Transcribing with MLX Whisper...")
+            result = mlx_whisper.transcribe(
+                audio,
+                path_or_hf_repo=self.model_name,
+                word_timestamps=True
+            )
+            segments = (
+                (segment["start"], segment["end"], segment["text"])
+                for segment in result["segments"]
+            )
+
+        elif self.backend == "faster_whisper":
+            # Use faster-whisper; segments is a lazy generator
+            logger.debug("Transcribing with faster-whisper...")
+            fw_segments, _ = self.model.transcribe(
+                audio,
+                vad_filter=True,
+                word_timestamps=False,
+            )
+            segments = (
+                (segment.start, segment.end, segment.text) for segment in fw_segments
+            )
+
+        elif self.backend == "whisper_cpp":
+            # Use whisper.cpp; segment t0/t1 are in centiseconds
+            logger.debug("Transcribing with whisper.cpp...")
+            segments = (
+                (segment.t0 / 100.0, segment.t1 / 100.0, segment.text)
+                for segment in self.model.transcribe(audio)
+            )
+
+        elif self.backend == "onnx":
+            # Use the INT8 ONNX Runtime model through the transformers pipeline
+            logger.debug("Transcribing with ONNX Runtime...")
+            result = self.model(
+                {"raw": audio, "sampling_rate": SAMPLING_RATE},
+                return_timestamps=True,
+                chunk_length_s=CHUNK_LENGTH_S,
+            )
+            segments = (
+                (chunk["timestamp"][0], chunk["timestamp"][1], chunk["text"])
+                for chunk in result.get("chunks", [])
+            )
+
+        else:
+            # The Hugging Face model only runs through transcribe_batch
+            raise RuntimeError(f"Backend {self.backend} does not support single-file transcription.")
 
-            start_delta = timedelta(seconds=start_time)
-            end_delta = timedelta(seconds=end_time)
-            text = chunk["text"].strip()
-
-            if text:
-                subtitle = srt.Subtitle(
-                    index=i + 1, start=start_delta, end=end_delta, content=text
-                )
-                srt_content.append(subtitle)
-        return srt.compose(srt_content)
-
-    def _format_as_srt_from_segments(self, segments):
-        srt_content = []
-        for i, segment in enumerate(segments):
-            start_time = segment["start"]
-            end_time = segment["end"]
-            text = segment["text"].strip()
-            start_delta = timedelta(seconds=start_time)
-            end_delta = timedelta(seconds=end_time)
-            if text:
-                subtitle = srt.Subtitle(index=i + 1, start=start_delta, end=end_delta, content=text)
-                srt_content.append(subtitle)
-        return srt.compose(srt_content)
\ No newline at end of file
+        yield from _clean_segments(segments, len(audio) / SAMPLING_RATE)
@@ -7,6 +7,15 @@ import { Card, CardContent, CardDescription, CardHeader, CardTitle } from './com
 import { Textarea } from './components/ui/textarea.jsx';
 import { Alert, AlertDescription, AlertTitle } from './components/ui/alert.jsx';
 
+const formatSrtTimestamp = (seconds) => {
+  const totalMs = Math.round(seconds * 1000);
+  const pad = (n, width = 2) => String(n).padStart(width, '0');
+  const h = Math.floor(totalMs / 3600000);
+  const m = Math.floor((totalMs % 3600000) / 60000);
+  const s = Math.floor((totalMs % 60000) / 1000);
+  return `${pad(h)}:${pad(m)}:${pad(s)},${pad(totalMs % 1000, 3)}`;
+};
+
 const App = () => {
   const [isRecording, setIsRecording] = useState(false);
   const [isTranscribing, setIsTranscribing] = useState(false);
@@ -148,9 +157,40 @@ const App = () => {
     formData.append('file', audioFile);
 
     try {
-      const response = await axios.post(API_URL, formData, { headers: { 'Content-Type': 'multipart/form-data' } });
-      setTranscript(response.data.transcript);
-      setSrtTranscript(response.data.srt_transcript);
+      const response = await fetch(API_URL, { method: 'POST', body: formData });
+      if (!response.ok || !response.body) {
+        throw new Error(`Transcription request failed with status ${response.status}`);
+      }
+
+      // The backend streams one JSON object per line (NDJSON), one per segment
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffered = '';
+      let text = '';
+      let srt = '';
+      let index = 0;
+      for (;;) {
+        const { done, value } = await reader.read();
+        buffered += decoder.decode(value, { stream: !done });
+        const lines = buffered.split('\n');
+        buffered = done ? '' : lines.pop();
+
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const message = JSON.parse(line);
+          if (message.error) throw new Error(message.error);
+          if (message.text === undefined) continue;  // final benchmark line
+
+          text += message.text;
+          // Segments without both timestamps still count as text but have no cue
+          if (typeof message.start !== 'number' || typeof message.end !== 'number') continue;
+          index += 1;
+          srt += `${index}\n${formatSrtTimestamp(message.start)} --> ${formatSrtTimestamp(message.end)}\n${message.text.trim()}\n\n`;
+        }
+        setTranscript(text.trim());
+        setSrtTranscript(srt);
+        if (done) break;
+      }
     } catch (err) {
       console.error('Error transcribing audio:', err);
       setError('Failed to transcribe audio. Please check the backend server and try again.');